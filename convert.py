@@ -1,95 +1,138 @@
 import logging
+from logging.handlers import MemoryHandler
+import os
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
 from typing import Tuple, Optional, List
-from docx import Document
-from openpyxl import Workbook
+from lxml import etree
+import xlsxwriter
 import re
-from docx.text.run import Run
-from docx.oxml.text.run import CT_R
 
 # Настройка логирования
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+_file_handler = logging.FileHandler('converter.log')
+_file_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+# Записи в файл копятся в памяти и сбрасываются пачкой, а при ошибке - сразу
+_log_buffer = MemoryHandler(capacity=1024, flushLevel=logging.ERROR, target=_file_handler)
 logging.basicConfig(
     level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
+    format=LOG_FORMAT,
     handlers=[
-        logging.FileHandler('converter.log'),
+        _log_buffer,
         logging.StreamHandler()
     ]
 )
 logger = logging.getLogger(__name__)
 
+# Элементы WordprocessingML, с которыми работает конвертер
+_W_NS = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+_W_BODY = f'{_W_NS}body'
+_W_P = f'{_W_NS}p'
+_W_R = f'{_W_NS}r'
+_W_RPR = f'{_W_NS}rPr'
+_W_B = f'{_W_NS}b'
+_W_I = f'{_W_NS}i'
+_W_T = f'{_W_NS}t'
+_W_TAB = f'{_W_NS}tab'
+_W_BREAKS = (f'{_W_NS}br', f'{_W_NS}cr')
+_W_VAL = f'{_W_NS}val'
+_ON_VALUES = ('1', 'true', 'on')
+# Класс span по признакам (bold, italic), упакованным в два бита
+_RUN_FORMATS = (None, 'italic', 'bold', 'bold italic')
+
+_ROMAN_NUMERALS = frozenset({'I', 'II', 'III', 'IV', 'V', 'VI', 'VII', 'VIII', 'IX', 'X'})
+
+# Регулярные выражения компилируются один раз при загрузке модуля
+# Каждая ветка начинается с литерала I, V или X, поэтому re пропускает
+# остальные символы без запуска сопоставления; (?<!\w.) заменяет \b перед числом
+_ROMAN_STRIP_RE = re.compile(r'I(?<!\w.)(?:II?|[VX])?\b[:, ]?'
+                             r'|V(?<!\w.)I{0,3}\b[:, ]?'
+                             r'|X(?<!\w.)\b[:, ]?')
+_BAD_TAG_RE = re.compile(r'<(?!/?span)[^>]+>')
+# Повторяющиеся двоеточия и запятые схлопываются за один проход
+_PUNCT_RUN_RE = re.compile(r'([:,])\1+')
+
 class TextProcessor:
     @staticmethod
     def is_roman_numeral(text: str) -> bool:
         """Проверяет, является ли текст римской цифрой."""
-        roman_pattern = r'^(I|II|III|IV|V|VI|VII|VIII|IX|X)$'
-        return bool(re.match(roman_pattern, text.strip()))
+        return text.strip() in _ROMAN_NUMERALS
 
     @staticmethod
     def normalize_text(text: str) -> str:
         """Нормализует текст, удаляя лишние пробелы."""
-        return re.sub(r'\s+', ' ', text).strip()
+        return ' '.join(text.split())
 
     @staticmethod
     def clean_first_word(word: str) -> str:
         """Очищает первое слово от знаков препинания."""
-        return re.sub(r'[,:]+$', '', word).strip()
+        return word.rstrip(',:').strip()
 
 class FormatProcessor:
     @staticmethod
-    def get_run_formatting(run: Run) -> Optional[str]:
-        """Определяет форматирование текстового фрагмента."""
-        if run.bold and run.italic:
-            return 'bold italic'
-        elif run.bold:
-            return 'bold'
-        elif run.italic:
-            return 'italic'
-        return None
+    def get_run_text(run: etree._Element) -> str:
+        """Возвращает текст элемента <w:r>, заменяя табуляции и переносы строк."""
+        text = ''
+        for child in run:
+            if child.tag == _W_T:
+                text += child.text or ''
+            elif child.tag == _W_TAB:
+                text += '\t'
+            elif child.tag in _W_BREAKS:
+                text += '\n'
+        return text
 
-    def process_runs(self, paragraph, skip_words: int = 0) -> str:
-        """Обрабатывает форматирование текстовых фрагментов параграфа."""
+    @staticmethod
+    def get_run_formatting(run: etree._Element) -> Optional[str]:
+        """Определяет форматирование текстового фрагмента по элементу <w:r>."""
+        rPr = run.find(_W_RPR)
+        if rPr is None:
+            return None
+        b, i = rPr.find(_W_B), rPr.find(_W_I)
+        bold = b is not None and b.get(_W_VAL, 'true') in _ON_VALUES
+        italic = i is not None and i.get(_W_VAL, 'true') in _ON_VALUES
+        return _RUN_FORMATS[bold << 1 | italic]
+
+    def process_runs(self, paragraph: etree._Element, run_texts: List[str],
+                     skip_words: int = 0) -> str:
+        """Обрабатывает форматирование фрагментов <w:p> по уже извлеченным текстам run_texts."""
+        # Теги span пишутся в общий буфер по мере смены форматирования,
+        # без промежуточных списков для каждой группы фрагментов
         formatted_text = []
         current_format = None
-        current_text = []
-        words_processed = 0
+        words_left = skip_words
+        get_run_formatting = self.get_run_formatting
         
-        for run in paragraph.runs:
-            run_text = run.text
+        for run, run_text in zip(paragraph.iterfind(_W_R), run_texts):
             if not run_text.strip():
-                if current_text and run_text.isspace():
-                    current_text.append(run_text)
+                if formatted_text and run_text.isspace():
+                    formatted_text.append(run_text)
                 continue
                 
-            if words_processed < skip_words:
-                words = run_text.split()
-                if len(words) + words_processed <= skip_words:
-                    words_processed += len(words)
+            if words_left:
+                # Разбиваем не дальше, чем нужно для пропуска оставшихся слов
+                words = run_text.split(None, words_left)
+                if len(words) <= words_left:
+                    words_left -= len(words)
                     continue
-                else:
-                    remaining_words = skip_words - words_processed
-                    run_text = ' '.join(words[remaining_words:])
-                    words_processed = skip_words
+                run_text = ' '.join(words[words_left].split())
+                words_left = 0
             
-            run_format = self.get_run_formatting(run)
+            run_format = get_run_formatting(run)
             
             if run_format != current_format:
-                if current_text:
-                    text = ''.join(current_text)
-                    if current_format:
-                        text = f'<span class="{current_format}">{text}</span>'
-                    formatted_text.append(text)
-                    current_text = []
+                if current_format:
+                    formatted_text.append('</span>')
+                if run_format:
+                    formatted_text.append(f'<span class="{run_format}">')
                 current_format = run_format
             
             # Сохраняем оригинальный текст без модификации пробелов
-            current_text.append(run_text)
+            formatted_text.append(run_text)
         
-        if current_text:
-            text = ''.join(current_text)
-            if current_format:
-                text = f'<span class="{current_format}">{text}</span>'
-            formatted_text.append(text)
+        if current_format:
+            formatted_text.append('</span>')
         
         # Объединяем текст, сохраняя оригинальные пробелы
         return ''.join(formatted_text)
@@ -99,9 +142,11 @@ class DocumentProcessor:
         self.text_processor = TextProcessor()
         self.format_processor = FormatProcessor()
 
-    def process_paragraph(self, paragraph) -> Tuple[str, str]:
-        """Обрабатывает параграф документа."""
-        text = self.text_processor.normalize_text(paragraph.text)
+    def process_paragraph(self, paragraph: etree._Element) -> Tuple[str, str]:
+        """Обрабатывает параграф документа, заданный элементом <w:p>."""
+        get_run_text = self.format_processor.get_run_text
+        run_texts = [get_run_text(run) for run in paragraph.iterfind(_W_R)]
+        text = self.text_processor.normalize_text(''.join(run_texts))
         words = text.split()
         if not words:
             return "", ""
@@ -131,22 +176,37 @@ class DocumentProcessor:
             elif words[0].endswith(','):
                 has_punctuation = ','
         
-        formatted_content = self.format_processor.process_runs(paragraph, skip_words)
-        formatted_content = re.sub(r'\b(I|II|III|IV|V|VI|VII|VIII|IX|X)\b[:, ]?', '', formatted_content)
-        formatted_content = re.sub(r'<(?!/?span)[^>]+>', '', formatted_content)
+        # Параграф состоит только из заголовка: от содержимого остается лишь знак
+        # препинания. Слово может быть разбито между фрагментами, поэтому
+        # окончательно проверяем число слов по фрагментам, как в process_runs
+        if (len(words) <= skip_words
+                and sum(len(run_text.split()) for run_text in run_texts) <= skip_words):
+            return first_word, has_punctuation or ""
+        
+        formatted_content = self.format_processor.process_runs(paragraph, run_texts, skip_words)
+        formatted_content = _ROMAN_STRIP_RE.sub('', formatted_content)
+        formatted_content = _BAD_TAG_RE.sub('', formatted_content)
         
         if has_punctuation:
-            if '<span' in formatted_content:
-                formatted_content = re.sub(r'(<span[^>]*>)(.*?)(</span>)', 
-                                       rf'\1\2{has_punctuation}\3', 
-                                       formatted_content, 
-                                       count=1)
+            span_start = formatted_content.find('<span')
+            if span_start != -1:
+                # Знак препинания ставится перед закрывающим тегом первого span,
+                # содержимое которого не разорвано переносом строки
+                while span_start != -1:
+                    text_start = formatted_content.find('>', span_start) + 1
+                    span_end = formatted_content.find('</span>', text_start)
+                    if not text_start or span_end == -1:
+                        break
+                    if formatted_content.find('\n', text_start, span_end) == -1:
+                        formatted_content = (formatted_content[:span_end] + has_punctuation
+                                             + formatted_content[span_end:])
+                        break
+                    span_start = formatted_content.find('<span', span_start + 1)
             else:
                 formatted_content = f'{has_punctuation} {formatted_content}'
         
-        formatted_content = re.sub(r'\s+', ' ', formatted_content).strip()
-        formatted_content = re.sub(r':{2,}', ':', formatted_content)
-        formatted_content = re.sub(r',{2,}', ',', formatted_content)
+        formatted_content = ' '.join(formatted_content.split())
+        formatted_content = _PUNCT_RUN_RE.sub(r'\1', formatted_content)
         
         return first_word, formatted_content
 
@@ -171,55 +231,71 @@ class BatchConverter:
             output_path = self.output_dir / f"{doc_path.stem}.xlsx"
             logger.info(f"Начало конвертации: {doc_path.name}")
             
-            doc = Document(doc_path)
-            wb = Workbook()
-            ws = wb.active
+            # В режиме constant_memory каждая строка сразу сбрасывается на диск.
+            # Строки записываются как есть, без превращения адресов в гиперссылки
+            wb = xlsxwriter.Workbook(str(output_path), {'constant_memory': True,
+                                                       'strings_to_urls': False})
+            ws = wb.add_worksheet('Sheet')
             
             # Добавляем заголовки
             headers = ['articleid', 'articlecat', 'articletitle', 'articleintrotext']
-            for col, header in enumerate(headers, 1):
-                ws.cell(row=1, column=col, value=header)
-            
-            row = 2
+            ws.write_row(0, 0, headers)
+            max_lengths = [len(header) for header in headers]
             article_id = 1  # Начальный номер для articleid
             article_cat = doc_path.stem.upper()  # Берем первую букву имени файла в верхнем регистре
             
-            for para in doc.paragraphs:
-                text = self.document_processor.text_processor.normalize_text(para.text)
-                if text:
+            # Читаем document.xml потоком, не загружая весь документ в память
+            with zipfile.ZipFile(doc_path) as docx, docx.open('word/document.xml') as xml:
+                for _, para in etree.iterparse(xml, events=('end',), tag=_W_P):
+                    body = para.getparent()
+                    # Обрабатываем только параграфы верхнего уровня, без таблиц
+                    if body.tag != _W_BODY:
+                        continue
+                    
+                    # Пустые параграфы возвращают пустой заголовок
                     title, content = self.document_processor.process_paragraph(para)
                     if title:
-                        # articleid (порядковый номер)
-                        ws.cell(row=row, column=1, value=article_id)
-                        # articlecat (буква файла)
-                        ws.cell(row=row, column=2, value=article_cat)
-                        # articletitle
-                        ws.cell(row=row, column=3, value=title)
-                        # articleintrotext
-                        ws.cell(row=row, column=4, value=f"<p>{content}</p>")
-                        
+                        # articleid, articlecat, articletitle, articleintrotext;
+                        # номер статьи совпадает с номером строки после заголовков
+                        intro = '<p>' + content + '</p>'
+                        if ws.write_row(article_id, 0, (article_id, article_cat, title, intro)) == -2:
+                            # xlsxwriter обрезает строки длиннее 32767 символов
+                            logger.warning(f"Файл {doc_path.name}: текст статьи {article_id} "
+                                           f"длиннее 32767 символов и обрезан")
+                        # Ширина столбцов отслеживается по ходу записи
+                        if len(title) > max_lengths[2]:
+                            max_lengths[2] = len(title)
+                        if len(intro) > max_lengths[3]:
+                            max_lengths[3] = len(intro)
                         article_id += 1  # Увеличиваем порядковый номер
-                        row += 1
+                    
+                    # Освобождаем уже обработанные элементы
+                    para.clear()
+                    while para.getprevious() is not None:
+                        del body[0]
+            
+            # Номер статьи только растет, а категория одна на весь файл,
+            # поэтому их ширина определяется по последней строке
+            if article_id > 1:
+                max_lengths[0] = max(max_lengths[0], len(str(article_id - 1)))
+                max_lengths[1] = max(max_lengths[1], len(article_cat))
             
             # Автоматическая настройка ширины столбцов
-            for column in ws.columns:
-                max_length = 0
-                column_letter = column[0].column_letter
-                for cell in column:
-                    try:
-                        if len(str(cell.value)) > max_length:
-                            max_length = len(str(cell.value))
-                    except:
-                        pass
+            for col, max_length in enumerate(max_lengths):
                 adjusted_width = min(max_length + 2, 100)  # Ограничиваем максимальную ширину
-                ws.column_dimensions[column_letter].width = adjusted_width
+                ws.set_column(col, col, adjusted_width)
             
-            wb.save(output_path)
-            logger.info(f"Файл {doc_path.name} успешно обработан. Параграфов: {row - 2}")
+            wb.close()
+            logger.info(f"Файл {doc_path.name} успешно обработан. Параграфов: {article_id - 1}")
             
         except Exception as e:
             logger.error(f"Ошибка при обработке файла {doc_path.name}: {str(e)}", exc_info=True)
-            raise
+            # Исключение передается из рабочего процесса через pickle, а часть
+            # исключений (например, XMLSyntaxError из lxml) не сериализуется
+            raise RuntimeError(str(e)) from None
+        finally:
+            # Рабочие процессы завершаются без сброса буферов логирования
+            _log_buffer.flush()
             
     def process_all_files(self) -> None:
         """Обрабатывает все Word файлы в директории input."""
@@ -233,12 +309,19 @@ class BatchConverter:
                 
             logger.info(f"Найдено файлов для обработки: {len(word_files)}")
             
-            for doc_path in word_files:
-                try:
-                    self.convert_single_file(doc_path)
-                except Exception as e:
-                    logger.error(f"Не удалось обработать файл {doc_path.name}: {str(e)}")
-                    continue
+            # Файлы независимы друг от друга и обрабатываются в отдельных процессах.
+            # Буфер лога сбрасывается заранее, чтобы процессы не унаследовали его записи
+            _log_buffer.flush()
+            max_workers = min(len(word_files), os.cpu_count() or 1)
+            with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                futures = {executor.submit(self.convert_single_file, doc_path): doc_path
+                           for doc_path in word_files}
+                for future in as_completed(futures):
+                    doc_path = futures[future]
+                    try:
+                        future.result()
+                    except Exception as e:
+                        logger.error(f"Не удалось обработать файл {doc_path.name}: {str(e)}")
                     
             logger.info("Обработка всех файлов завершена")
             